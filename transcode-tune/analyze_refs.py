@@ -5,10 +5,19 @@
 """
 
 import json
+import os
 import subprocess
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import Optional
 
+from jsonio import dump_json
+
+
+# 目录模式下识别的视频文件后缀
+VIDEO_SUFFIXES = ('.mp4', '.mkv', '.mov', '.ts')
+
 
 def analyze_video(video_path: str) -> dict:
     """使用ffprobe分析视频"""
@@ -33,48 +42,62 @@ def analyze_video(video_path: str) -> dict:
     
     format_info = data.get('format', {})
     
-    # 帧分析 - 获取所有帧信息
+    # 帧分析 - 流式读取逐帧信息，边读边统计，不在内存中保留完整帧列表
     frame_cmd = [
         'ffprobe', '-v', 'quiet',
         '-select_streams', 'v:0',
         '-show_entries', 'frame=pict_type,pkt_size,pkt_pts_time',
-        '-of', 'json',
+        '-of', 'compact=p=0',
+        '-threads', '1',  # 并行分析时每个进程单线程解码，避免过度订阅
         video_path
     ]
     
-    frame_result = subprocess.run(frame_cmd, capture_output=True, text=True)
-    frames = json.loads(frame_result.stdout).get('frames', [])
-    
     # 分类统计
-    i_frames = [f for f in frames if f.get('pict_type') == 'I']
-    p_frames = [f for f in frames if f.get('pict_type') == 'P']
-    b_frames = [f for f in frames if f.get('pict_type') == 'B']
-    
-    iframe_sizes = [int(f['pkt_size']) for f in i_frames if f.get('pkt_size')]
-    pframe_sizes = [int(f['pkt_size']) for f in p_frames if f.get('pkt_size')]
-    bframe_sizes = [int(f['pkt_size']) for f in b_frames if f.get('pkt_size')]
+    stats = {t: {'count': 0, 'sized': 0, 'sum': 0, 'max': 0, 'min': 0} for t in 'IPB'}
+    frame_data = []  # (pts_time, size)，用于按时间窗口计算码率
+    
+    with subprocess.Popen(frame_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          text=True, bufsize=1 << 20) as proc:
+        for line in proc.stdout:
+            # 格式: pict_type=I|pkt_size=12345|pkt_pts_time=0.040000 (字段顺序由ffprobe决定)
+            fields = {}
+            for item in line.rstrip('\n').split('|'):
+                k, _, v = item.partition('=')
+                fields[k] = v
+            
+            size_str = fields.get('pkt_size', '')
+            size = int(size_str) if size_str.isdigit() else 0
+            
+            st = stats.get(fields.get('pict_type'))
+            if st is not None:
+                st['count'] += 1
+                if size_str.isdigit():
+                    if st['sized'] == 0 or size < st['min']:
+                        st['min'] = size
+                    if size > st['max']:
+                        st['max'] = size
+                    st['sized'] += 1
+                    st['sum'] += size
+            
+            pts_str = fields.get('pkt_pts_time', 'N/A')
+            if pts_str not in ('', 'N/A'):
+                frame_data.append((float(pts_str), size))
     
-    # 码率统计 - 按时间窗口计算
+    # 码率统计 - 按1秒窗口计算瞬时码率，一次bincount完成所有窗口
     bitrate_samples = []
-    window_size = 1.0  # 1秒窗口
     
-    if frames:
-        # 按时间分组计算瞬时码率
-        frame_data = [(float(f.get('pkt_pts_time', 0)), int(f.get('pkt_size', 0))) 
-                      for f in frames if f.get('pkt_pts_time') is not None]
-        frame_data.sort(key=lambda x: x[0])
+    if frame_data:
+        times = np.fromiter((f[0] for f in frame_data), dtype=np.float64, count=len(frame_data))
+        sizes = np.fromiter((f[1] for f in frame_data), dtype=np.int64, count=len(frame_data))
         
-        if frame_data:
-            duration = frame_data[-1][0] - frame_data[0][0]
-            total_bytes = sum(f[1] for f in frame_data)
-            avg_bitrate = (total_bytes * 8) / duration / 1000 if duration > 0 else 0  # kbps
-            
-            # 计算每秒码率
-            for t in range(int(frame_data[0][0]), int(frame_data[-1][0]) + 1):
-                window_bytes = sum(f[1] for f in frame_data 
-                                   if t <= f[0] < t + window_size)
-                if window_bytes > 0:
-                    bitrate_samples.append(window_bytes * 8 / window_size / 1000)
+        seconds = np.floor(times).astype(np.int64)
+        per_sec_bytes = np.bincount(seconds - seconds.min(), weights=sizes)
+        per_sec_bytes = per_sec_bytes[per_sec_bytes > 0]
+        bitrate_samples = (per_sec_bytes * 8 / 1000).tolist()
+    
+    def avg_size(t: str) -> int:
+        st = stats[t]
+        return st['sum'] // st['sized'] if st['sized'] else 0
     
     return {
         'file': str(video_path),
@@ -83,18 +106,18 @@ def analyze_video(video_path: str) -> dict:
         'bitrate_max_kbps': int(max(bitrate_samples)) if bitrate_samples else 0,
         'bitrate_min_kbps': int(min(bitrate_samples)) if bitrate_samples else 0,
         'iframe': {
-            'count': len(i_frames),
-            'avg_size': int(sum(iframe_sizes) / len(iframe_sizes)) if iframe_sizes else 0,
-            'max_size': max(iframe_sizes) if iframe_sizes else 0,
-            'min_size': min(iframe_sizes) if iframe_sizes else 0,
+            'count': stats['I']['count'],
+            'avg_size': avg_size('I'),
+            'max_size': stats['I']['max'],
+            'min_size': stats['I']['min'],
         },
         'pframe': {
-            'count': len(p_frames),
-            'avg_size': int(sum(pframe_sizes) / len(pframe_sizes)) if pframe_sizes else 0,
+            'count': stats['P']['count'],
+            'avg_size': avg_size('P'),
         },
         'bframe': {
-            'count': len(b_frames),
-            'avg_size': int(sum(bframe_sizes) / len(bframe_sizes)) if bframe_sizes else 0,
+            'count': stats['B']['count'],
+            'avg_size': avg_size('B'),
         },
         'resolution': f"{video_stream.get('width', 0)}x{video_stream.get('height', 0)}",
         'fps': eval(video_stream.get('r_frame_rate', '0/1')),
@@ -102,8 +125,9 @@ def analyze_video(video_path: str) -> dict:
     }
 
 
-def analyze_batch(files_path: str, output: Optional[str] = None) -> dict:
-    """批量分析文件"""
+def analyze_batch(files_path: str, output: Optional[str] = None,
+                  jobs: Optional[int] = None) -> dict:
+    """批量分析文件，jobs为并行进程数(默认CPU核数)"""
     
     files = Path(files_path)
     if not files.exists():
@@ -116,19 +140,27 @@ def analyze_batch(files_path: str, output: Optional[str] = None) -> dict:
         with open(files, 'r', encoding='utf-8') as f:
             video_files = [line.strip() for line in f if line.strip()]
     else:
-        # 当作目录处理
-        video_files = list(files.glob('*.mp4')) + list(files.glob('*.mkv'))
-        video_files = [str(f) for f in video_files]
-    
-    results = []
-    for i, video_path in enumerate(video_files, 1):
-        print(f"[{i}/{len(video_files)}] 分析: {video_path}")
-        result = analyze_video(video_path)
-        results.append(result)
+        # 当作目录处理: 一次扫描，小文件优先(更快看到结果)
+        entries = [e for e in os.scandir(files)
+                   if e.is_file(follow_symlinks=False) and e.name.lower().endswith(VIDEO_SUFFIXES)]
+        entries.sort(key=lambda e: e.stat(follow_symlinks=False).st_size)
+        video_files = [e.path for e in entries]
+    
+    # 每个文件独立分析，多进程并行跑ffprobe；结果按输入顺序保存
+    results = [None] * len(video_files)
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(analyze_video, path): i
+                   for i, path in enumerate(video_files)}
         
-        # 实时输出
-        print(f"  码率: {result.get('bitrate_avg_kbps', 'N/A')} kbps")
-        print(f"  I帧: avg={result['iframe']['avg_size']}, max={result['iframe']['max_size']}")
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            result = future.result()
+            results[i] = result
+            
+            # 实时输出
+            print(f"[{done}/{len(video_files)}] 分析: {video_files[i]}")
+            print(f"  码率: {result.get('bitrate_avg_kbps', 'N/A')} kbps")
+            print(f"  I帧: avg={result['iframe']['avg_size']}, max={result['iframe']['max_size']}")
     
     # 汇总统计
     if results:
@@ -152,8 +184,7 @@ def analyze_batch(files_path: str, output: Optional[str] = None) -> dict:
     if output:
         out_path = Path(output)
         out_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(out_path, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, indent=2, ensure_ascii=False)
+        dump_json(out_path, summary)
         print(f"\n✅ 结果已保存: {out_path}")
     
     # 生成推荐目标配置
@@ -177,6 +208,7 @@ def main():
     parser = argparse.ArgumentParser(description='参考流分析工具')
     parser.add_argument('files', help='文件列表(files.txt)或目录路径')
     parser.add_argument('-o', '--output', default=None, help='输出JSON路径')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='并行分析进程数(默认CPU核数)')
     parser.add_argument('--remote', default=None, help='远程主机 (user@host)，会通过SSH分析')
     
     args = parser.parse_args()
@@ -186,7 +218,7 @@ def main():
         print("⚠️ 远程分析暂未实现，请先下载到本地")
         return
     
-    analyze_batch(args.files, args.output)
+    analyze_batch(args.files, args.output, args.jobs)
 
 
 if __name__ == '__main__':
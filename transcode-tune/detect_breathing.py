@@ -5,122 +5,286 @@
 """
 
 import json
+import re
 import subprocess
+import tempfile
 import numpy as np
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
+import matplotlib
+matplotlib.use('Agg')  # 只输出图片文件，不需要交互式后端
 import matplotlib.pyplot as plt
 
+from jsonio import dump_json
 
-def compute_frame_psnr(distorted: str, reference: str) -> list[dict]:
+# Numba JIT (可选，未安装时帧统计以普通Python执行)
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# ijson 流式JSON解析 (可选，未安装时整体json.load)
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# 逐帧质量指标 (compute_frame_psnr / compute_frame_psnr_vmaf 的返回格式)，缺失值为NaN
+FRAME_METRICS_DTYPE = np.dtype([
+    ('frame', np.int32),
+    ('pts', np.float64),
+    ('psnr', np.float32),
+    ('ssim', np.float32),
+    ('vmaf', np.float32),
+])
+
+
+# 无损帧psnr为inf，与libvmaf和 transcode_tune.PSNR_MAX 一样截断到60
+PSNR_MAX = 60.0
+
+# psnr滤镜 stats_file 的逐帧行
+_PSNR_STATS_RE = re.compile(rb'n:(\d+)\s.*?\bpsnr_avg:(\S+)')
+
+
+def iter_ffmpeg_stdout(cmd: list[str]) -> Iterator[bytes]:
+    """运行ffmpeg并逐行产出stdout，不在内存中保留完整输出"""
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          bufsize=1 << 16) as proc:
+        yield from proc.stdout
+
+
+def compute_frame_psnr(distorted: str, reference: str) -> np.ndarray:
     """
     逐帧计算PSNR
-    返回: [{'frame': 0, 'pts': 0.0, 'pict_type': 'I', 'psnr': 42.5}, ...]
+    返回: FRAME_METRICS_DTYPE 结构化数组，每帧一行
     """
     
     # 使用ffmpeg的fpsync滤镜逐帧对比
     cmd = [
-        'ffmpeg', '-i', reference, '-i', distorted,
+        'ffmpeg', '-nostats', '-loglevel', 'error',
+        '-i', reference, '-i', distorted,
         '-lavfi', 'psnr=stats_file=-',  # 输出到stdout
         '-f', 'null', '-'
     ]
     
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    
-    # 解析PSNR输出
-    frames = []
-    for line in result.stderr.split('\n'):
-        if line.startswith('n:') or 'psnr' in line.lower():
-            # 格式: n:0 pts:0 ... psnr:42.5 ...
-            parts = {}
-            for item in line.split():
-                if ':' in item:
-                    k, v = item.split(':', 1)
-                    parts[k] = v
-            
-            if 'n' in parts:
-                frames.append({
-                    'frame': int(parts.get('n', 0)),
-                    'pts': float(parts.get('pts', 0)),
-                    'psnr': float(parts.get('psnr', 0)) if 'psnr' in parts else None
-                })
-    
-    # 如果上面解析失败，用另一种方法
-    if not frames:
+    # 边读边解析PSNR输出，直接在bytes上匹配
+    # 格式: n:1 mse_avg:0.52 ... psnr_avg:50.97 psnr_y:50.38 ... (stats_file中没有pts)
+    frames = np.fromiter(
+        ((int(m[1]), np.nan, min(float(m[2]), PSNR_MAX), np.nan, np.nan)
+         for m in map(_PSNR_STATS_RE.match, iter_ffmpeg_stdout(cmd)) if m),
+        dtype=FRAME_METRICS_DTYPE
+    )
+    
+    # 如果上面解析失败(如ffmpeg缺少psnr滤镜)，再用libvmaf完整跑一遍
+    if not len(frames):
         frames = compute_frame_psnr_vmaf(distorted, reference)
     
     return frames
 
 
-def compute_frame_psnr_vmaf(distorted: str, reference: str) -> list[dict]:
+def _iter_vmaf_frames(log_file):
+    """逐帧读取libvmaf JSON日志中的 frames 数组 (有ijson时流式解析)"""
+    if ijson is not None:
+        yield from ijson.items(log_file, 'frames.item', use_float=True)
+    else:
+        yield from json.load(log_file).get('frames', [])
+
+
+def compute_frame_psnr_vmaf(distorted: str, reference: str) -> np.ndarray:
     """
     使用libvmaf的per-frame模式计算PSNR
+    返回: FRAME_METRICS_DTYPE 结构化数组，每帧一行
     """
     
-    cmd = [
-        'ffmpeg', '-i', reference, '-i', distorted,
-        '-lavfi', (
-            "libvmaf="
-            "model=version=vmaf_v0.6.1:"
-            "feature=name=psnr|name=ssim:"
-            "log_path=-:"
-            "log_fmt=json"
-        ),
-        '-f', 'null', '-'
-    ]
-    
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    
-    # VMAF会输出JSON到stderr
-    try:
-        # 找到JSON部分
-        output = result.stderr
-        json_start = output.find('{')
-        if json_start >= 0:
-            data = json.loads(output[json_start:])
-            frames = []
-            for frame_data in data.get('frames', []):
-                metrics = frame_data.get('metrics', {})
-                frames.append({
-                    'frame': frame_data.get('frameNum', 0),
-                    'pts': frame_data.get('pooled_metrics', {}).get('psnr', {}).get('min', 0),
-                    'psnr': metrics.get('psnr', 0),
-                    'ssim': metrics.get('ssim', 0),
-                    'vmaf': metrics.get('vmaf', 0)
-                })
-            return frames
-    except Exception as e:
-        print(f"[WARN] JSON解析失败: {e}")
-    
-    return []
+    frames = np.empty(1024, dtype=FRAME_METRICS_DTYPE)
+    n = 0
+    
+    # libvmaf在结束时把日志写入log_path指定的文件，不会输出到stderr
+    # 在临时目录中运行并使用相对路径，避免在滤镜参数里转义Windows盘符
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cmd = [
+            'ffmpeg', '-nostats', '-loglevel', 'error',
+            # 第一路输入为待测视频，第二路为参考视频 (与 run_metrics 一致)
+            '-i', str(Path(distorted).resolve()),
+            '-i', str(Path(reference).resolve()),
+            '-lavfi', (
+                "libvmaf="
+                "model=version=vmaf_v0.6.1:"
+                "feature=name=psnr|name=ssim:"
+                "log_path=vmaf.json:"
+                "log_fmt=json"
+            ),
+            '-f', 'null', '-'
+        ]
+        # -loglevel error 下stderr只剩错误信息，保留用于报错
+        result = subprocess.run(cmd, cwd=tmp_dir, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True)
+        
+        try:
+            with open(Path(tmp_dir) / 'vmaf.json', 'rb') as f:
+                for frame_data in _iter_vmaf_frames(f):
+                    if n == len(frames):
+                        frames.resize(2 * n, refcheck=False)
+                    # libvmaf v2 的键名为 psnr_y / float_ssim
+                    metrics = frame_data.get('metrics', {})
+                    frames[n] = (
+                        frame_data.get('frameNum', n),
+                        np.nan,  # 日志中没有时间戳
+                        min(metrics.get('psnr', metrics.get('psnr_y', np.nan)), PSNR_MAX),
+                        metrics.get('ssim', metrics.get('float_ssim', np.nan)),
+                        metrics.get('vmaf', np.nan),
+                    )
+                    n += 1
+        except Exception as e:
+            print(f"[WARN] JSON解析失败: {e} {result.stderr.strip()}")
+    
+    frames.resize(n, refcheck=False)
+    return frames
+
 
+# 帧类型编码: frames['types'] 中 I=0, P=1, B=2, 其他=3
+PICT_TYPES = 'IPB?'
+PICT_CODES = {'I': 0, 'P': 1, 'B': 2}
 
-def get_frame_types(video: str) -> list[dict]:
+
+def get_frame_types(video: str) -> dict[str, np.ndarray]:
     """
     获取每帧的类型(I/P/B)和大小
+    逐行读取ffprobe的compact输出，避免生成和解析整段JSON
+    返回按列存储的数组: {'types': uint8, 'sizes': int64, 'pts': float64}
     """
     
     cmd = [
         'ffprobe', '-v', 'quiet',
         '-select_streams', 'v:0',
         '-show_entries', 'frame=pict_type,pkt_size,pkt_pts_time',
-        '-of', 'json',
+        '-of', 'compact=p=0',
         video
     ]
     
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    data = json.loads(result.stdout)
-    
-    frames = []
-    for i, f in enumerate(data.get('frames', [])):
-        frames.append({
-            'frame': i,
-            'pts': float(f.get('pkt_pts_time', 0)),
-            'pict_type': f.get('pict_type', '?'),
-            'size': int(f.get('pkt_size', 0))
-        })
-    
-    return frames
+    types, sizes, pts = [], [], []
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          text=True, bufsize=1 << 20) as proc:
+        for line in proc.stdout:
+            # 格式: pict_type=I|pkt_size=12345|pkt_pts_time=0.040000
+            fields = {}
+            for item in line.rstrip('\n').split('|'):
+                k, _, v = item.partition('=')
+                fields[k] = v
+            
+            t = fields.get('pkt_pts_time', '')
+            size = fields.get('pkt_size', '')
+            types.append(PICT_CODES.get(fields.get('pict_type'), 3))
+            sizes.append(int(size) if size.isdigit() else 0)
+            pts.append(float(t) if t not in ('', 'N/A') else 0.0)
+    
+    return {
+        'types': np.array(types, dtype=np.uint8),
+        'sizes': np.array(sizes, dtype=np.int64),
+        'pts': np.array(pts, dtype=np.float64),
+    }
+
+
+@njit(cache=True)
+def _frame_stats(types, sizes):
+    """
+    单次遍历统计帧类型/大小和GOP长度
+    各数组按帧类型编码索引，size_* 只统计大小>0的帧
+    返回: (counts, size_cnt, size_sum, size_sumsq, size_max, size_min, gop_mean, gop_std)
+    """
+    counts = np.zeros(4, np.int64)
+    size_cnt = np.zeros(4, np.int64)
+    size_sum = np.zeros(4, np.float64)
+    size_sumsq = np.zeros(4, np.float64)
+    size_max = np.zeros(4, np.int64)
+    size_min = np.zeros(4, np.int64)
+    
+    gop_cnt = 0
+    gop_sum = 0.0
+    gop_sumsq = 0.0
+    prev_i_frame = -1
+    
+    for k in range(len(types)):
+        t = types[k]
+        counts[t] += 1
+        
+        size = sizes[k]
+        if size > 0:
+            if size_cnt[t] == 0 or size < size_min[t]:
+                size_min[t] = size
+            if size > size_max[t]:
+                size_max[t] = size
+            size_cnt[t] += 1
+            size_sum[t] += size
+            size_sumsq[t] += size * size
+        
+        if t == 0:
+            if prev_i_frame >= 0:
+                gop = k - prev_i_frame
+                gop_cnt += 1
+                gop_sum += gop
+                gop_sumsq += gop * gop
+            prev_i_frame = k
+    
+    gop_mean = 0.0
+    gop_std = 0.0
+    if gop_cnt > 0:
+        gop_mean = gop_sum / gop_cnt
+        gop_std = np.sqrt(max(gop_sumsq / gop_cnt - gop_mean * gop_mean, 0.0))
+    
+    return counts, size_cnt, size_sum, size_sumsq, size_max, size_min, gop_mean, gop_std
+
+
+# 呼吸效应评分规则: 指标 -> [(阈值, 分数, 问题描述), ...]，阈值从高到低，命中第一档
+BREATHING_RULES = {
+    'size_cv': [
+        (50, 30, "帧大小波动剧烈 (CV={:.1f}%)"),
+        (30, 15, "帧大小波动较大 (CV={:.1f}%)"),
+    ],
+    'i_p_ratio': [
+        (5, 30, "I/P帧大小差异过大 (ratio={:.1f})"),
+        (3, 15, "I/P帧大小差异较大 (ratio={:.1f})"),
+    ],
+    'psnr_range': [
+        (5, 40, "PSNR波动过大 (range={:.1f}dB)"),
+        (3, 20, "PSNR波动较大 (range={:.1f}dB)"),
+    ],
+    'psnr_diff': [
+        (2, 20, "I/P帧PSNR差异大 (Δ={:.1f}dB)"),
+    ],
+}
+
+
+def _rule_points(name: str, value):
+    """按规则表查出某项指标的得分，value可以是标量或数组"""
+    levels = BREATHING_RULES[name]
+    value = np.asarray(value)
+    return np.select([value > threshold for threshold, _, _ in levels],
+                     [points for _, points, _ in levels], 0)
+
+
+def _score(cv, ipr, psnr_range=0, psnr_diff=0):
+    """
+    呼吸效应分数 (查表计算，无分支)
+    参数可以是标量，也可以是多个视频的指标数组，用于批量评分
+    """
+    return (_rule_points('size_cv', cv) + _rule_points('i_p_ratio', ipr)
+            + _rule_points('psnr_range', psnr_range) + _rule_points('psnr_diff', psnr_diff))
+
+
+def _issues(values: dict[str, float]) -> list[str]:
+    """列出命中规则的问题描述"""
+    issues = []
+    for name, value in values.items():
+        for threshold, _, message in BREATHING_RULES[name]:
+            if value > threshold:
+                issues.append(message.format(value))
+                break
+    return issues
 
 
 def analyze_breathing(video: str, reference: Optional[str] = None, 
@@ -142,47 +306,33 @@ def analyze_breathing(video: str, reference: Optional[str] = None,
     # 获取帧类型和大小
     print("  获取帧信息...")
     frame_info = get_frame_types(video)
+    types = frame_info['types']
+    sizes = frame_info['sizes']
+    total_frames = len(types)
     
-    # 分离I/P/B帧
-    i_frames = [f for f in frame_info if f['pict_type'] == 'I']
-    p_frames = [f for f in frame_info if f['pict_type'] == 'P']
-    b_frames = [f for f in frame_info if f['pict_type'] == 'B']
+    # 单次遍历完成帧计数、帧大小和GOP统计
+    counts, size_cnt, size_sum, size_sumsq, _, _, avg_gop, gop_std = _frame_stats(types, sizes)
+    i_count, p_count, b_count = (int(c) for c in counts[:3])
     
-    print(f"  总帧数: {len(frame_info)}, I帧: {len(i_frames)}, P帧: {len(p_frames)}, B帧: {len(b_frames)}")
+    print(f"  总帧数: {total_frames}, I帧: {i_count}, P帧: {p_count}, B帧: {b_count}")
     
     # 帧大小统计
-    i_sizes = [f['size'] for f in i_frames if f['size'] > 0]
-    p_sizes = [f['size'] for f in p_frames if f['size'] > 0]
-    b_sizes = [f['size'] for f in b_frames if f['size'] > 0]
-    
-    i_avg = np.mean(i_sizes) if i_sizes else 0
-    p_avg = np.mean(p_sizes) if p_sizes else 0
-    b_avg = np.mean(b_sizes) if b_sizes else 0
+    type_avg = np.divide(size_sum, size_cnt, out=np.zeros(4), where=size_cnt > 0)
+    i_avg, p_avg, b_avg = (float(a) for a in type_avg[:3])
     
     # 计算帧大小波动系数
-    all_sizes = [f['size'] for f in frame_info if f['size'] > 0]
-    size_std = np.std(all_sizes) if all_sizes else 0
-    size_mean = np.mean(all_sizes) if all_sizes else 0
+    all_cnt = size_cnt.sum()
+    size_mean = float(size_sum.sum() / all_cnt) if all_cnt else 0
+    size_std = float(np.sqrt(max(size_sumsq.sum() / all_cnt - size_mean ** 2, 0))) if all_cnt else 0
     size_cv = (size_std / size_mean * 100) if size_mean > 0 else 0  # 变异系数%
     
-    # GOP分析 - 检测周期性
-    if len(i_frames) >= 2:
-        gop_lengths = []
-        for i in range(1, len(i_frames)):
-            gop_lengths.append(i_frames[i]['frame'] - i_frames[i-1]['frame'])
-        avg_gop = np.mean(gop_lengths) if gop_lengths else 0
-        gop_std = np.std(gop_lengths) if gop_lengths else 0
-    else:
-        avg_gop = 0
-        gop_std = 0
-    
     result = {
         'video': str(video),
-        'total_frames': len(frame_info),
+        'total_frames': total_frames,
         'frame_counts': {
-            'I': len(i_frames),
-            'P': len(p_frames),
-            'B': len(b_frames)
+            'I': i_count,
+            'P': p_count,
+            'B': b_count
         },
         'frame_sizes': {
             'I_avg': int(i_avg),
@@ -192,8 +342,8 @@ def analyze_breathing(video: str, reference: Optional[str] = None,
             'size_cv': round(size_cv, 2)  # 变异系数，越大波动越剧烈
         },
         'gop': {
-            'avg_length': round(avg_gop, 1),
-            'std': round(gop_std, 1)
+            'avg_length': round(float(avg_gop), 1),
+            'std': round(float(gop_std), 1)
         }
     }
     
@@ -202,68 +352,52 @@ def analyze_breathing(video: str, reference: Optional[str] = None,
         print(f"  计算帧级PSNR (参考: {reference})...")
         psnr_frames = compute_frame_psnr(video, reference)
         
-        if psnr_frames:
-            # 合并帧信息
-            for i, f in enumerate(frame_info):
-                if i < len(psnr_frames):
-                    f.update(psnr_frames[i])
+        if len(psnr_frames):
+            # 合并帧信息: 按帧序号对齐，缺失或为0的PSNR记为NaN
+            psnr = np.full(total_frames, np.nan, dtype=np.float32)
+            n = min(total_frames, len(psnr_frames))
+            psnr[:n] = psnr_frames['psnr'][:n]
+            psnr[psnr == 0] = np.nan
+            frame_info['psnr'] = psnr
             
-            # 按帧类型统计PSNR
-            i_psnrs = [f.get('psnr', 0) for f in frame_info if f['pict_type'] == 'I' and f.get('psnr')]
-            p_psnrs = [f.get('psnr', 0) for f in frame_info if f['pict_type'] == 'P' and f.get('psnr')]
-            b_psnrs = [f.get('psnr', 0) for f in frame_info if f['pict_type'] == 'B' and f.get('psnr')]
+            # 按帧类型分段统计PSNR: 一次bincount得到各类型的帧数和总和
+            valid = ~np.isnan(psnr)
+            values = psnr[valid].astype(np.float64)
+            cnt = np.bincount(types[valid], minlength=4)
+            total = np.bincount(types[valid], weights=values, minlength=4)
+            type_mean = np.divide(total, cnt, out=np.zeros(4), where=cnt > 0)
+            i_mean, p_mean, b_mean = (float(m) for m in type_mean[:3])
             
-            all_psnrs = [f.get('psnr', 0) for f in frame_info if f.get('psnr')]
-            psnr_mean = np.mean(all_psnrs) if all_psnrs else 0
-            psnr_std = np.std(all_psnrs) if all_psnrs else 0
-            psnr_range = (max(all_psnrs) - min(all_psnrs)) if all_psnrs else 0
+            n_valid = len(values)
+            psnr_mean = float(total.sum() / n_valid) if n_valid else 0
+            psnr_std = float(np.sqrt(max(values @ values / n_valid - psnr_mean ** 2, 0))) if n_valid else 0
+            psnr_range = float(values.max() - values.min()) if n_valid else 0
             
             result['psnr'] = {
                 'mean': round(psnr_mean, 2),
                 'std': round(psnr_std, 2),
                 'range': round(psnr_range, 2),
-                'I_mean': round(np.mean(i_psnrs), 2) if i_psnrs else 0,
-                'P_mean': round(np.mean(p_psnrs), 2) if p_psnrs else 0,
-                'B_mean': round(np.mean(b_psnrs), 2) if b_psnrs else 0,
+                'I_mean': round(i_mean, 2),
+                'P_mean': round(p_mean, 2),
+                'B_mean': round(b_mean, 2),
             }
     
     # 呼吸效应评估
-    breathing_score = 0
-    issues = []
-    
-    # 1. 帧大小变异系数过大
-    if size_cv > 50:
-        breathing_score += 30
-        issues.append(f"帧大小波动剧烈 (CV={size_cv:.1f}%)")
-    elif size_cv > 30:
-        breathing_score += 15
-        issues.append(f"帧大小波动较大 (CV={size_cv:.1f}%)")
-    
-    # 2. I帧和P帧大小比例过大
+    # 1. 帧大小变异系数  2. I帧和P帧大小比例  3. PSNR波动及I/P帧PSNR差异
     i_p_ratio = result['frame_sizes']['I_P_ratio']
-    if i_p_ratio > 5:
-        breathing_score += 30
-        issues.append(f"I/P帧大小差异过大 (ratio={i_p_ratio:.1f})")
-    elif i_p_ratio > 3:
-        breathing_score += 15
-        issues.append(f"I/P帧大小差异较大 (ratio={i_p_ratio:.1f})")
-    
-    # 3. PSNR波动
+    psnr_range = psnr_diff = 0
     if 'psnr' in result:
         psnr_range = result['psnr']['range']
-        if psnr_range > 5:
-            breathing_score += 40
-            issues.append(f"PSNR波动过大 (range={psnr_range:.1f}dB)")
-        elif psnr_range > 3:
-            breathing_score += 20
-            issues.append(f"PSNR波动较大 (range={psnr_range:.1f}dB)")
-        
-        # I帧和P帧PSNR差异
         if result['psnr']['I_mean'] > 0 and result['psnr']['P_mean'] > 0:
             psnr_diff = result['psnr']['I_mean'] - result['psnr']['P_mean']
-            if psnr_diff > 2:
-                breathing_score += 20
-                issues.append(f"I/P帧PSNR差异大 (Δ={psnr_diff:.1f}dB)")
+    
+    breathing_score = int(_score(size_cv, i_p_ratio, psnr_range, psnr_diff))
+    issues = _issues({
+        'size_cv': size_cv,
+        'i_p_ratio': i_p_ratio,
+        'psnr_range': psnr_range,
+        'psnr_diff': psnr_diff,
+    })
     
     # 评级
     if breathing_score >= 70:
@@ -313,11 +447,10 @@ def analyze_breathing(video: str, reference: Optional[str] = None,
         out_path.mkdir(parents=True, exist_ok=True)
         
         # JSON结果
-        with open(out_path / 'breathing_analysis.json', 'w', encoding='utf-8') as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        dump_json(out_path / 'breathing_analysis.json', result)
         
         # 生成图表
-        if len(frame_info) > 0:
+        if total_frames > 0:
             generate_plots(frame_info, out_path)
         
         print(f"\n📁 结果已保存: {out_path}")
@@ -325,40 +458,75 @@ def analyze_breathing(video: str, reference: Optional[str] = None,
     return result
 
 
-def generate_plots(frame_info: list[dict], output_dir: Path):
+# 帧数超过 PLOT_MAX_POINTS 时帧大小图改为按 PLOT_BINS 个区间分箱绘制
+PLOT_MAX_POINTS = 5000
+PLOT_BINS = 2000
+
+
+def generate_plots(frame_info: dict[str, np.ndarray], output_dir: Path):
     """生成分析图表"""
     
     try:
         fig, axes = plt.subplots(2, 1, figsize=(14, 8))
         
-        frames = [f['frame'] for f in frame_info]
-        sizes = [f['size'] / 1024 for f in frame_info]  # KB
-        types = [f['pict_type'] for f in frame_info]
+        types = frame_info['types']
+        frames = np.arange(len(types))
+        sizes = frame_info['sizes'] / 1024  # KB
         
         # 帧大小图
         ax1 = axes[0]
-        colors = ['red' if t == 'I' else 'blue' if t == 'P' else 'green' 
-                  for t in types]
-        ax1.scatter(frames, sizes, c=colors, s=1, alpha=0.6)
+        colors = ['red', 'blue', 'green']
+        
+        # 帧数过多时按帧序号分箱绘制，避免逐点绘制几十万个点
+        binned = len(frames) > PLOT_MAX_POINTS
+        if binned:
+            bins = frames * PLOT_BINS // len(frames)
+            centers = (np.arange(PLOT_BINS) + 0.5) * len(frames) / PLOT_BINS
+            
+            # 每种帧类型画一条箱内平均大小曲线
+            for code, color in enumerate(colors):
+                mask = (types == code) if code < 2 else (types >= code)
+                cnt = np.bincount(bins[mask], minlength=PLOT_BINS)
+                total = np.bincount(bins[mask], weights=sizes[mask], minlength=PLOT_BINS)
+                has = cnt > 0
+                ax1.plot(centers[has], total[has] / cnt[has], color=color,
+                         linewidth=0.8, rasterized=True)
+            ax1.set_title('Frame Size Distribution, binned mean (Red=I, Blue=P, Green=B)')
+        else:
+            ax1.scatter(frames, sizes, c=np.array(colors + ['green'])[types],
+                        s=1, alpha=0.6, rasterized=True)
+            ax1.set_title('Frame Size Distribution (Red=I, Blue=P, Green=B)')
         ax1.set_xlabel('Frame')
         ax1.set_ylabel('Frame Size (KB)')
-        ax1.set_title('Frame Size Distribution (Red=I, Blue=P, Green=B)')
         ax1.grid(True, alpha=0.3)
         
         # PSNR图 (如果有)
         ax2 = axes[1]
-        psnrs = [f.get('psnr') for f in frame_info]
-        valid_psnr = [p for p in psnrs if p is not None and p > 0]
+        psnrs = frame_info.get('psnr')
         
-        if valid_psnr:
-            ax2.plot(frames, psnrs, linewidth=0.5, alpha=0.8)
+        if psnrs is not None and not np.isnan(psnrs).all():
+            if binned:
+                # 分箱: 平均值曲线 + 最小/最大值区间，保留质量骤降的可见性
+                valid = ~np.isnan(psnrs)
+                b, v = bins[valid], psnrs[valid].astype(np.float64)
+                cnt = np.bincount(b, minlength=PLOT_BINS)
+                total = np.bincount(b, weights=v, minlength=PLOT_BINS)
+                lo = np.full(PLOT_BINS, np.inf)
+                hi = np.full(PLOT_BINS, -np.inf)
+                np.minimum.at(lo, b, v)
+                np.maximum.at(hi, b, v)
+                has = cnt > 0
+                ax2.fill_between(centers[has], lo[has], hi[has], alpha=0.3, linewidth=0)
+                ax2.plot(centers[has], total[has] / cnt[has], linewidth=0.8)
+            else:
+                ax2.plot(frames, psnrs, linewidth=0.5, alpha=0.8, rasterized=True)
             ax2.set_xlabel('Frame')
             ax2.set_ylabel('PSNR (dB)')
             ax2.set_title('Per-Frame PSNR')
             ax2.grid(True, alpha=0.3)
             
             # 标记I帧位置
-            i_frame_nums = [f['frame'] for f in frame_info if f['pict_type'] == 'I']
+            i_frame_nums = np.flatnonzero(types == PICT_CODES['I'])
             for i_fn in i_frame_nums[::max(1, len(i_frame_nums)//20)]:  # 最多标记20个
                 ax2.axvline(x=i_fn, color='red', alpha=0.2, linewidth=0.5)
         else:
@@ -367,7 +535,7 @@ def generate_plots(frame_info: list[dict], output_dir: Path):
             ax2.set_title('Per-Frame PSNR (No Data)')
         
         plt.tight_layout()
-        plt.savefig(output_dir / 'breathing_analysis.png', dpi=150)
+        plt.savefig(output_dir / 'breathing_analysis.png', dpi=100)
         plt.close()
         
         print(f"📈 图表已生成: {output_dir / 'breathing_analysis.png'}")
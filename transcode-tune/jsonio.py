@@ -0,0 +1,59 @@
+"""
+JSON读写工具
+analyze_refs.py / detect_breathing.py / transcode_tune.py 共用
+"""
+
+import json
+from typing import Any, Iterator
+
+# orjson (可选，C实现的JSON读写，未安装时使用标准库json)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def load_json(path) -> Any:
+    """读JSON文件，有orjson时用orjson"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dump_json(path, obj, indent: bool = True):
+    """写JSON文件，有orjson时用orjson"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=option))
+    else:
+        def default(o):
+            # 与 OPT_SERIALIZE_NUMPY 对齐: numpy 标量/数组转为 Python 对象
+            if hasattr(o, 'tolist'):
+                return o.tolist()
+            raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=2 if indent else None, ensure_ascii=False, default=default)
+
+
+def json_line(obj) -> bytes:
+    """紧凑的单行JSON (用于.jsonl)"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def iter_jsonl(path) -> Iterator[Any]:
+    """逐行读取.jsonl，跳过空行和被截断的最后一行"""
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                yield loads(line)
+            except ValueError:
+                continue
@@ -4,15 +4,36 @@ Transcode Parameter Tuner - 自动化转码参数迭代工具
 支持批量文件处理和实验归档
 """
 
+import hashlib
+import itertools
 import json
+import math
+import os
+import re
+import shlex
+import shutil
 import yaml
 import time
 import subprocess
+import tempfile
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
-from typing import Any, Optional
-from copy import deepcopy
+from functools import lru_cache
+from typing import Any, Callable, Iterator, Optional
+
+from jsonio import dump_json, iter_jsonl, json_line, load_json
+
+# YAML使用libyaml的C解析器，不可用时退回纯Python实现
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 # Windows 通知
 try:
@@ -43,6 +64,11 @@ def send_notification(title: str, message: str):
     print(f"{'='*50}\n")
 
 
+def result_cache_key(input_uri: str, params: dict) -> str:
+    """(输入, 参数组合) 的缓存键，与参数顺序无关"""
+    return json.dumps([input_uri, sorted(params.items())], ensure_ascii=False)
+
+
 class Experiment:
     """实验管理"""
     
@@ -52,10 +78,16 @@ class Experiment:
         self.template_path = self.exp_dir / 'base.json'
         self.files_path = self.exp_dir / 'files.txt'
         self.results_dir = self.exp_dir / 'results'
+        self.cache_path = self.results_dir / 'analysis_cache.json'
         
         self.config = None
         self.template = None
         self.files = []
+        self.analysis_cache: dict[str, dict] = {}
+        self.input_uri_path = ('input', 'uri')
+        self.output_uri_path = ('output', 'uri')
+        self.patch_plan = {}
+        self.patcher = None
         
     def load(self) -> bool:
         """加载实验配置"""
@@ -64,15 +96,34 @@ class Experiment:
             return False
         
         with open(self.config_path, 'r', encoding='utf-8') as f:
-            self.config = yaml.safe_load(f)
+            self.config = yaml.load(f, Loader=YamlLoader)
         
         # 加载模板
         template_path = self.config.get('template', 'base.json')
         if not Path(template_path).is_absolute():
             template_path = self.exp_dir / template_path
         
-        with open(template_path, 'r', encoding='utf-8') as f:
-            self.template = json.load(f)
+        self.template = load_json(template_path)
+        
+        # 每个任务要改的路径(参数 + 输入/输出URI)是固定的，预先合并成一棵树
+        uri_paths = self.config.get('uri_paths', {})
+        self.input_uri_path = split_path(uri_paths.get('input', 'input.uri'))
+        self.output_uri_path = split_path(uri_paths.get('output', 'output.uri'))
+        try:
+            self.patch_plan = build_patch_plan(
+                [split_path(p) for p in self.config.get('params', {})]
+                + [self.input_uri_path, self.output_uri_path]
+            )
+        except ValueError as e:
+            print(f"❌ {e}")
+            return False
+        self.patcher = compile_patch_plan(self.patch_plan)
+        # 用空值试跑一遍，模板里路径上有列表/标量时在加载阶段就报错
+        try:
+            self.patcher(self.template, defaultdict(lambda: None))
+        except TypeError as e:
+            print(f"❌ {e}")
+            return False
         
         # 加载文件列表
         files_path = self.config.get('files', 'files.txt')
@@ -88,6 +139,44 @@ class Experiment:
         
         return True
     
+    def load_cache(self):
+        """从历史结果和 analysis_cache.json 恢复 (输入, 参数) -> 分析结果"""
+        cache = {}
+        for summary_path in sorted(self.results_dir.glob('*/summary.json')):
+            try:
+                summary = load_json(summary_path)
+            except (OSError, ValueError):
+                continue
+            for param_results in summary.get('all_results', []):
+                for file_result in param_results.get('files', []):
+                    analysis = file_result.get('analysis')
+                    if analysis and 'error' not in analysis:
+                        key = result_cache_key(file_result['input_uri'], param_results['params'])
+                        cache[key] = analysis
+        # 中途退出、没来得及生成 summary.json 的运行
+        for results_path in sorted(self.results_dir.glob('*/results.jsonl')):
+            if (results_path.parent / 'summary.json').exists():
+                continue
+            try:
+                for record in iter_jsonl(results_path):
+                    analysis = record.get('analysis')
+                    if analysis and 'error' not in analysis:
+                        cache[result_cache_key(record['input_uri'], record['params'])] = analysis
+            except OSError:
+                continue
+        try:
+            cache.update(load_json(self.cache_path))
+        except (OSError, ValueError):
+            pass
+        self.analysis_cache = cache
+    
+    def save_cache(self):
+        """原子写入缓存，中途被打断也不会留下半个文件"""
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix('.json.tmp')
+        dump_json(tmp_path, self.analysis_cache, indent=False)
+        os.replace(tmp_path, self.cache_path)
+    
     def create_structure(self, name: str):
         """创建新实验目录结构"""
         self.exp_dir = Path('experiments') / name
@@ -132,54 +221,141 @@ class Experiment:
         print(f"   - {self.files_path}")
 
 
-def set_nested_value(obj: dict, path: str, value: Any):
-    """通过路径设置嵌套字典的值"""
-    keys = path.split('.')
-    current = obj
-    for key in keys[:-1]:
-        if key not in current:
-            current[key] = {}
-        current = current[key]
-    current[keys[-1]] = value
-
-
-def get_nested_value(obj: dict, path: str, default=None) -> Any:
-    """通过路径获取嵌套字典的值"""
-    keys = path.split('.')
-    current = obj
-    for key in keys:
-        if isinstance(current, dict) and key in current:
-            current = current[key]
-        else:
-            return default
-    return current
+@lru_cache(maxsize=None)
+def split_path(path: str) -> tuple[str, ...]:
+    """'a.b.c' -> ('a', 'b', 'c')，同一路径只拆分一次"""
+    return tuple(path.split('.'))
+
+
+def build_patch_plan(paths: list[tuple[str, ...]]) -> dict:
+    """
+    把要修改的路径合并成一棵树，共享的前缀只出现一次，叶子为完整路径元组
+    路径重复或一条是另一条的前缀(如 encoder 和 encoder.bitrate)时抛 ValueError
+    """
+    plan = {}
+    for keys in paths:
+        node = plan
+        for key in keys[:-1]:
+            child = node.setdefault(key, {})
+            if not isinstance(child, dict):
+                raise ValueError(f"参数路径冲突: {'.'.join(child)} 与 {'.'.join(keys)}")
+            node = child
+        if keys[-1] in node:
+            raise ValueError(f"参数路径冲突: {'.'.join(keys)} 重复或与更深的路径重叠")
+        node[keys[-1]] = keys
+    return plan
 
 
-def inject_params(template: dict, params: dict[str, Any]) -> dict:
-    """将参数注入模板"""
-    result = deepcopy(template)
-    for path, value in params.items():
-        set_nested_value(result, path, value)
-    return result
+def patch_child(node: dict, key: str, path: tuple[str, ...]) -> dict:
+    """patch plan 的中间节点: 不存在时新建，是对象时浅拷贝，是列表/标量时抛 TypeError"""
+    if key not in node:
+        return {}
+    child = node[key]
+    if not isinstance(child, dict):
+        raise TypeError(f"参数路径 {'.'.join(path)} 在模板中是 {type(child).__name__}，不是对象")
+    return dict(child)
 
 
-def generate_param_combinations(param_defs: dict) -> list[dict]:
-    """生成参数组合"""
-    import itertools
+def compile_patch_plan(plan: dict) -> Callable[[dict, dict], dict]:
+    """
+    把 patch plan 生成为一个直线代码的写时复制函数: patch(obj, values) -> 新dict
+    路径上的每个字典只浅拷贝一次，其余子树与 obj 共享；values 以路径元组为键
+    
+    例如 plan 为 {'input': {'uri': ('input', 'uri')}} 时生成:
+    
+        def patch(obj, values):
+            d0 = dict(obj)
+            d1 = patch_child(d0, 'input', ('input',))
+            d0['input'] = d1
+            d1['uri'] = values[('input', 'uri')]
+            return d0
+    """
+    lines = ['def patch(obj, values):', '    d0 = dict(obj)']
+    names = itertools.count(1)
     
+    def emit(node: dict, var: str, prefix: tuple[str, ...]):
+        for key, sub in node.items():
+            if isinstance(sub, dict):
+                child = f'd{next(names)}'
+                lines.append(f'    {child} = patch_child({var}, {key!r}, {prefix + (key,)!r})')
+                lines.append(f'    {var}[{key!r}] = {child}')
+                emit(sub, child, prefix + (key,))
+            else:
+                lines.append(f'    {var}[{key!r}] = values[{sub!r}]')
+    
+    emit(plan, 'd0', ())
+    lines.append('    return d0')
+    namespace = {'patch_child': patch_child}
+    exec('\n'.join(lines), namespace)
+    return namespace['patch']
+
+
+def _param_values(param_defs: dict) -> tuple[list[str], list[list]]:
+    """参数名列表和对应的取值列表(单值视为一个取值)"""
     keys = list(param_defs.keys())
     values = [v if isinstance(v, list) else [v] for v in param_defs.values()]
+    return keys, values
+
+
+def count_param_combinations(param_defs: dict, strategy: str = 'grid',
+                             budget: Optional[int] = None) -> int:
+    """generate_param_combinations 会生成的组合数"""
+    _, values = _param_values(param_defs)
+    total = math.prod(len(v) for v in values)
+    if strategy == 'sobol' and budget:
+        return min(budget, total)
+    return total
+
+
+def generate_param_combinations(param_defs: dict, strategy: str = 'grid',
+                                budget: Optional[int] = None) -> Iterator[dict]:
+    """
+    按需生成参数组合
     
-    combinations = []
-    for combo in itertools.product(*values):
-        combinations.append(dict(zip(keys, combo)))
-    return combinations
+    strategy:
+        grid  - 全组合 (itertools.product)
+        sobol - Sobol准随机采样，最多生成budget个不重复组合 (需要scipy)
+    """
+    keys, values = _param_values(param_defs)
+    
+    if strategy == 'grid':
+        for combo in itertools.product(*values):
+            yield dict(zip(keys, combo))
+    elif strategy == 'sobol':
+        from scipy.stats.qmc import Sobol
+        
+        total = count_param_combinations(param_defs, strategy, budget)
+        sampler = Sobol(d=len(keys))
+        seen = set()
+        while len(seen) < total:
+            # Sobol序列按2的幂取样才能保持均匀性
+            batch = 1 << max(total - len(seen) - 1, 0).bit_length()
+            for point in sampler.random(batch):
+                combo = tuple(
+                    min(int(u * len(v)), len(v) - 1) for u, v in zip(point, values)
+                )
+                if combo in seen:
+                    continue
+                seen.add(combo)
+                yield {k: v[i] for k, v, i in zip(keys, values, combo)}
+                if len(seen) == total:
+                    return
+    else:
+        raise ValueError(f"未知搜索策略: {strategy}")
+
+
+# 复用HTTP连接(keep-alive)，避免每个任务重新握手
+# 重试只针对建立连接失败，POST本身不会被重发，不会重复提交转码任务
+SESSION = requests.Session()
+SESSION.headers['Connection'] = 'keep-alive'
+SESSION.mount('http://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5)))
+SESSION.mount('https://', HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.5)))
 
 
 def trigger_transcode(api_url: str, payload: dict) -> tuple[bool, Optional[str]]:
     """触发转码任务，返回 (成功, 任务ID或错误信息)"""
     try:
-        resp = requests.post(api_url, json=payload, timeout=60)
+        resp = SESSION.post(api_url, json=payload, timeout=60)
         resp.raise_for_status()
         data = resp.json()
         task_id = data.get('task_id') or data.get('id') or 'unknown'
@@ -190,51 +366,116 @@ def trigger_transcode(api_url: str, payload: dict) -> tuple[bool, Optional[str]]
         return False, str(e)
 
 
+# SSH连接复用: 第一次ssh建立主连接并保持10分钟，之后的轮询和scp复用同一TCP/认证会话
+# Windows的OpenSSH不支持ControlMaster，不启用
+SSH_MUX_OPTS = [
+    '-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/ssh-%r@%h:%p', '-o', 'ControlPersist=600',
+] if os.name != 'nt' else []
+
+
+def remote_path_of(uri: str) -> str:
+    """file:/path/to/file.mp4 -> /path/to/file.mp4"""
+    return uri[5:] if uri.startswith('file:') else uri
+
+
 def ssh_command(host: str, user: str, cmd: str, timeout: int = 30) -> tuple[bool, str]:
-    """执行SSH命令"""
-    ssh_cmd = f"ssh -o ConnectTimeout=10 -o StrictHostKeyChecking=no {user}@{host} '{cmd}'"
-    result = subprocess.run(ssh_cmd, shell=True, capture_output=True, text=True, timeout=timeout)
+    """执行SSH命令 (直接exec，不经过本地shell)"""
+    ssh_cmd = ['ssh', '-o', 'ConnectTimeout=10', '-o', 'StrictHostKeyChecking=no',
+               *SSH_MUX_OPTS, f'{user}@{host}', cmd]
+    result = subprocess.run(ssh_cmd, capture_output=True, text=True, timeout=timeout)
     return result.returncode == 0, result.stdout.strip()
 
 
-def wait_for_output(host: str, user: str, output_uri: str, 
-                    check_interval: int = 10, max_wait: int = 3600) -> bool:
-    """等待远程输出文件就绪"""
-    # 从 file:///path/to/file.mp4 提取路径
-    if output_uri.startswith('file:'):
-        remote_path = output_uri[5:]  # 去掉 file:
-    else:
-        remote_path = output_uri
-    
-    # 轮询检查
-    start = time.time()
-    while time.time() - start < max_wait:
-        success, output = ssh_command(host, user, f"test -f {remote_path} && echo READY")
-        if "READY" in output:
-            # 额外检查文件是否完整（没有被写入）
-            success, size1 = ssh_command(host, user, f"stat -c %s {remote_path} 2>/dev/null")
-            if success and size1:
-                time.sleep(2)
-                success, size2 = ssh_command(host, user, f"stat -c %s {remote_path} 2>/dev/null")
-                if size1 == size2 and size1 != '0':
-                    print(f"[OK] 文件已就绪: {remote_path}")
-                    return True
-        
-        print(f"[等待] {check_interval}秒后重试...")
-        time.sleep(check_interval)
+# results.jsonl 每写入这么多条 fsync 一次，兼顾安全和磁盘压力
+RESULTS_FSYNC_EVERY = 16
+# analysis_cache.json 每新增这么多条重写一次，其余时间靠 results.jsonl 兜底
+CACHE_SAVE_EVERY = 32
+
+# 在途输出轮询: 间隔从 POLL_MIN 秒指数退避到 POLL_MAX 秒，单个输出最长等待 OUTPUT_MAX_WAIT 秒
+POLL_MIN, POLL_MAX = 2, 10
+OUTPUT_MAX_WAIT = 3600
+
+
+class RemoteReadinessPoller:
+    """在途输出就绪检查: 每轮一次ssh stat覆盖全部文件，与在途数量无关"""
     
-    return False
+    def __init__(self, host: str, user: str, max_wait: float = OUTPUT_MAX_WAIT):
+        self.host = host
+        self.user = user
+        self.max_wait = max_wait
+        self.pending: dict[str, list] = {}  # 远程路径 -> [附带数据, 开始时间, 上次大小]
+    
+    def __len__(self) -> int:
+        return len(self.pending)
+    
+    def add(self, remote_path: str, item: Any):
+        if remote_path in self.pending:
+            raise ValueError(f"输出路径重复: {remote_path}")
+        self.pending[remote_path] = [item, time.time(), None]
+    
+    def sizes(self) -> dict[str, int]:
+        """远程文件大小，不存在的文件不出现在结果里"""
+        cmd = "stat -c '%n %s' " + ' '.join(shlex.quote(p) for p in self.pending) + ' 2>/dev/null'
+        # 有文件不存在时stat返回非零，但已存在文件的结果照常输出
+        try:
+            _, output = ssh_command(self.host, self.user, cmd)
+        except (subprocess.TimeoutExpired, OSError) as e:
+            # SSH卡住或起不来时本轮当作没有进展，下轮再查
+            print(f"[WARN] 检查远程文件失败: {e}")
+            return {}
+        sizes = {}
+        for line in output.splitlines():
+            path, _, size = line.rpartition(' ')
+            if size.isdigit():
+                sizes[path] = int(size)
+        return sizes
+    
+    def poll(self) -> tuple[list, list, bool]:
+        """检查一轮，返回 (就绪的附带数据, 超时的附带数据, 是否有进展)
+        
+        两次采样大小一致且非零，说明文件已写完
+        """
+        sizes = self.sizes()
+        ready, expired, changed = [], [], False
+        now = time.time()
+        for remote_path, entry in list(self.pending.items()):
+            item, started, last_size = entry
+            size = sizes.get(remote_path)
+            if size and size == last_size:
+                print(f"[OK] 文件已就绪: {remote_path}")
+                ready.append(item)
+            elif now - started > self.max_wait:
+                print(f"[ERROR] 等待超时: {remote_path}")
+                expired.append(item)
+            else:
+                changed = changed or size != last_size
+                entry[2] = size
+                continue
+            del self.pending[remote_path]
+        return ready, expired, changed or bool(ready or expired)
+
+
+# 有rsync时优先用: 复用ControlMaster连接，中断后可续传
+# 远端没装rsync的主机记下来，之后直接用scp
+RSYNC = shutil.which('rsync')
+_hosts_without_rsync: set[str] = set()
 
 
 def download_file(host: str, user: str, remote_uri: str, local_path: str) -> bool:
     """下载文件"""
-    if remote_uri.startswith('file:'):
-        remote_path = remote_uri[5:]
-    else:
-        remote_path = remote_uri
-    
-    scp_cmd = f"scp {user}@{host}:{remote_path} {local_path}"
-    result = subprocess.run(scp_cmd, shell=True, capture_output=True, text=True)
+    remote = f'{user}@{host}:{remote_path_of(remote_uri)}'
+    result = None
+    if RSYNC and host not in _hosts_without_rsync:
+        cmd = [RSYNC, '-e', ' '.join(['ssh', *SSH_MUX_OPTS]), '--inplace', '--partial',
+               remote, local_path]
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0 and 'not found' in result.stderr:
+            print(f"[WARN] {host} 上没有rsync，改用scp")
+            _hosts_without_rsync.add(host)
+            result = None
+    if result is None:
+        cmd = ['scp', *SSH_MUX_OPTS, remote, local_path]
+        result = subprocess.run(cmd, capture_output=True, text=True)
     
     if result.returncode == 0:
         print(f"[OK] 已下载: {local_path}")
@@ -243,49 +484,153 @@ def download_file(host: str, user: str, remote_uri: str, local_path: str) -> boo
     return False
 
 
-def analyze_video(video_path: str) -> dict:
-    """分析视频码率/I帧"""
+# 分析结果缓存: 内存 + 磁盘两级，键为文件头64KB哈希+大小+修改时间
+ANALYSIS_CACHE_DIR = Path('.cache') / 'analysis'
+_analysis_memo: dict[str, dict] = {}
+_cache_keys: dict[tuple, str] = {}  # (绝对路径, 大小, mtime) -> 内容指纹
+
+# 同时运行的 ffprobe/ffmpeg 不超过CPU核数；下载线程再多，分析也不会互相抢核
+MEDIA_SLOTS = threading.BoundedSemaphore(os.cpu_count() or 4)
+
+
+def file_cache_key(path: str) -> str:
+    """文件内容指纹，文件被覆盖或修改后自动失效"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = (path, st.st_size, st.st_mtime_ns)
+    # 同一进程内文件未变时不再重复读取文件头
+    if stat_key not in _cache_keys:
+        with open(path, 'rb') as f:
+            head = f.read(65536)
+        _cache_keys[stat_key] = f"{hashlib.blake2b(head, digest_size=8).hexdigest()}_{st.st_size}_{int(st.st_mtime)}"
+    return _cache_keys[stat_key]
+
+
+IFRAME_TARGETS = ('iframe_avg_size', 'iframe_max_size')
+
+
+def needs_packets(targets: Optional[dict]) -> bool:
+    """目标里有I帧指标时才需要逐packet统计，targets为None时按全部分析"""
+    return targets is None or any(k in targets for k in IFRAME_TARGETS)
+
+
+def analyze_video(video_path: str, targets: Optional[dict] = None) -> dict:
+    """分析视频码率/I帧，同一文件重复分析时直接返回缓存结果
+
+    targets 中没有I帧指标时只读容器信息，不遍历packet
+    """
+    try:
+        key = file_cache_key(video_path)
+    except OSError as e:
+        return {'error': str(e)}
+    
+    with_packets = needs_packets(targets)
+    # 完整结果可以满足只要容器信息的请求，反之不行
+    keys = [key] if with_packets else [key, f'{key}_format']
+    for k in keys:
+        if k in _analysis_memo:
+            return dict(_analysis_memo[k])
+        try:
+            result = load_json(ANALYSIS_CACHE_DIR / f'{k}.json')
+            _analysis_memo[k] = result
+            return dict(result)
+        except (OSError, ValueError):
+            pass
+    
+    with MEDIA_SLOTS:
+        result = probe_video(video_path, with_packets)
+    if 'error' in result:
+        return result  # 失败结果不缓存，允许重试
+    k = keys[-1]
+    ANALYSIS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    dump_json(ANALYSIS_CACHE_DIR / f'{k}.json', result, indent=False)
+    _analysis_memo[k] = result
+    return dict(result)
+
+
+PROBE_TIMEOUT = 180  # 单次ffprobe的最长时间(秒)
+
+
+def probe_video(video_path: str, with_packets: bool = True) -> dict:
+    """分析视频码率/I帧 (单次ffprobe，流式解析format/stream/packet)"""
+    # 只输出用到的字段，长视频的packet输出量减少一大半
+    entries = 'format=duration,bit_rate:stream=codec_type,width,height'
+    if with_packets:
+        entries += ':packet=size,flags'
     cmd = [
         'ffprobe', '-v', 'quiet',
-        '-print_format', 'json',
-        '-show_format', '-show_streams',
+        '-select_streams', 'v:0',
+        '-show_entries', entries,
         video_path
     ]
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        data = json.loads(result.stdout)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                text=True, bufsize=1 << 20)
+        timed_out = threading.Event()
         
-        video_stream = next(
-            (s for s in data.get('streams', []) if s['codec_type'] == 'video'),
-            None
-        )
-        if not video_stream:
-            return {'error': 'No video stream'}
+        def kill():
+            timed_out.set()
+            proc.kill()
         
-        format_info = data.get('format', {})
-        bitrate_avg = int(format_info.get('bit_rate', 0)) // 1000
+        watchdog = threading.Timer(PROBE_TIMEOUT, kill)
+        watchdog.start()
         
-        # I帧分析
-        frame_cmd = [
-            'ffprobe', '-v', 'quiet', '-select_streams', 'v:0',
-            '-show_entries', 'frame=pict_type,pkt_size',
-            '-of', 'json', video_path
-        ]
-        frame_result = subprocess.run(frame_cmd, capture_output=True, text=True, timeout=120)
-        frames = json.loads(frame_result.stdout).get('frames', [])
+        format_info = {}
+        video_stream = None
+        iframe_count = iframe_total = iframe_max = 0
         
-        i_frames = [f for f in frames if f.get('pict_type') == 'I']
-        iframe_sizes = [int(f.get('pkt_size', 0)) for f in i_frames if f.get('pkt_size')]
+        # 默认输出格式: [PACKET]/[STREAM]/[FORMAT] 包围 key=value 行
+        section, fields = None, {}
+        try:
+            for line in proc.stdout:
+                line = line.rstrip('\n')
+                if line in ('[PACKET]', '[STREAM]', '[FORMAT]'):
+                    section, fields = line[1:-1], {}
+                elif section and line == f'[/{section}]':
+                    if section == 'PACKET':
+                        # 关键帧packet即I帧，边读边累计
+                        size = fields.get('size', '')
+                        if 'K' in fields.get('flags', '') and size.isdigit():
+                            iframe_count += 1
+                            iframe_total += int(size)
+                            iframe_max = max(iframe_max, int(size))
+                    elif section == 'STREAM':
+                        if fields.get('codec_type') == 'video':
+                            video_stream = fields
+                    else:
+                        format_info = fields
+                    section = None
+                elif section:
+                    key, _, value = line.partition('=')
+                    fields.setdefault(key, value)  # 嵌套的SIDE_DATA不覆盖外层字段
+        finally:
+            watchdog.cancel()
+            proc.wait()
+        
+        # 被杀或出错时输出不完整，不能当作有效结果 (否则会缓存 bitrate_avg: 0)
+        if timed_out.is_set():
+            return {'error': f'ffprobe 超时 ({PROBE_TIMEOUT}s)'}
+        if proc.returncode != 0:
+            return {'error': f'ffprobe 退出码 {proc.returncode}'}
+        
+        if not video_stream:
+            return {'error': 'No video stream'}
         
-        return {
-            'bitrate_avg': bitrate_avg,
-            'iframe_avg_size': sum(iframe_sizes) // len(iframe_sizes) if iframe_sizes else 0,
-            'iframe_max_size': max(iframe_sizes) if iframe_sizes else 0,
-            'iframe_count': len(i_frames),
-            'duration': float(format_info.get('duration', 0)),
+        bitrate = format_info.get('bit_rate', '')
+        duration = format_info.get('duration', '')
+        result = {
+            'bitrate_avg': int(bitrate) // 1000 if bitrate.isdigit() else 0,
+            'duration': float(duration) if duration not in ('', 'N/A') else 0.0,
             'resolution': f"{video_stream.get('width')}x{video_stream.get('height')}",
         }
+        if with_packets:
+            result.update({
+                'iframe_avg_size': iframe_total // iframe_count if iframe_count else 0,
+                'iframe_max_size': iframe_max,
+                'iframe_count': iframe_count,
+            })
+        return result
     except Exception as e:
         return {'error': str(e)}
 
@@ -318,53 +663,121 @@ def check_targets(analysis: dict, targets: dict) -> tuple[bool, list[str]]:
     return passed, issues
 
 
+# 质量指标 -> (libvmaf特征名, 日志pooled_metrics中的键)，vmaf由模型本身输出
+VMAF_FEATURES = {
+    'psnr': ('psnr', 'psnr_y'),
+    'ssim': ('float_ssim', 'float_ssim'),
+}
+
+
+# 不需要VMAF时用原生滤镜，stats_file 每帧一行，取亮度分量
+NATIVE_METRICS = {
+    'psnr': re.compile(r'\bpsnr_y:(\S+)'),
+    'ssim': re.compile(r'\bY:(\S+)'),
+}
+PSNR_MAX = 60.0  # 无损帧psnr为inf，与libvmaf一样截断
+
+
+def metrics_filter(metrics: list[str]) -> str:
+    """按请求的指标构建滤镜图: 含vmaf时全部交给libvmaf，否则只用psnr/ssim滤镜"""
+    if 'vmaf' in metrics:
+        features = [VMAF_FEATURES[m][0] for m in metrics if m in VMAF_FEATURES]
+        options = ['log_path=vmaf.json', 'log_fmt=json']
+        if features:
+            options.insert(0, "feature='" + '|'.join(f'name={f}' for f in features) + "'")
+        return 'libvmaf=' + ':'.join(options)
+    
+    native = [m for m in NATIVE_METRICS if m in metrics]
+    if len(native) == 1:
+        return f'{native[0]}=stats_file={native[0]}.log'
+    # 两个滤镜共用同一次解码
+    return ('[0:v]split[d0][d1];[1:v]split[r0][r1];'
+            '[d0][r0]psnr=stats_file=psnr.log;[d1][r1]ssim=stats_file=ssim.log')
+
+
+def read_stats_mean(log_path: Path, pattern: re.Pattern) -> Optional[float]:
+    """psnr/ssim stats_file 的逐帧均值"""
+    total = count = 0
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            match = pattern.search(line)
+            if match:
+                total += min(float(match.group(1)), PSNR_MAX)
+                count += 1
+    return total / count if count else None
+
+
 def run_metrics(video_path: str, ref_path: str, metrics: list[str]) -> dict:
-    """运行PSNR/VMAF"""
-    results = {}
+    """运行PSNR/SSIM/VMAF，一次ffmpeg调用(一次解码)计算全部请求的指标"""
+    if not any(m in metrics for m in ('vmaf', *NATIVE_METRICS)):
+        return {}
     
-    if 'psnr' in metrics:
-        cmd = ['ffmpeg', '-i', ref_path, '-i', video_path,
-               '-lavfi', 'psnr', '-f', 'null', '-']
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        for line in result.stderr.split('\n'):
-            if 'PSNR' in line:
-                results['psnr'] = line.strip()
-                break
+    # 第一路输入为待测视频，第二路为参考视频
+    # 在临时目录中运行并使用相对日志路径，避免在滤镜参数里转义Windows盘符
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cmd = ['ffmpeg', '-nostats', '-loglevel', 'error',
+               '-i', str(Path(video_path).resolve()),
+               '-i', str(Path(ref_path).resolve()),
+               '-lavfi', metrics_filter(metrics), '-f', 'null', '-']
+        # -loglevel error 下stderr只剩错误信息，保留用于报错
+        with MEDIA_SLOTS:
+            result = subprocess.run(cmd, cwd=tmp_dir, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, text=True)
+        
+        try:
+            if 'vmaf' not in metrics:
+                values = {
+                    m: read_stats_mean(Path(tmp_dir) / f'{m}.log', pattern)
+                    for m, pattern in NATIVE_METRICS.items() if m in metrics
+                }
+                return {m: round(v, 4) for m, v in values.items() if v is not None}
+            pooled = load_json(Path(tmp_dir) / 'vmaf.json').get('pooled_metrics', {})
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] 质量评估失败: {e} {result.stderr.strip()}")
+            return {}
     
-    if 'vmaf' in metrics:
-        cmd = ['ffmpeg', '-i', ref_path, '-i', video_path,
-               '-lavfi', 'libvmaf', '-f', 'null', '-']
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        for line in result.stderr.split('\n'):
-            if 'VMAF' in line.lower():
-                results['vmaf'] = line.strip()
-                break
+    keys = {m: VMAF_FEATURES[m][1] for m in metrics if m in VMAF_FEATURES}
+    keys['vmaf'] = 'vmaf'
+    return {
+        m: round(pooled[key]['mean'], 4)
+        for m, key in keys.items() if m in metrics and key in pooled
+    }
+
+
+def fetch_and_analyze(remote: dict, output_uri: str, local_file: Path,
+                      targets: dict) -> Optional[tuple[dict, bool, list[str]]]:
+    """下载并分析转码输出，返回 (分析结果, 是否达标, 问题列表)，下载失败返回None"""
+    if not download_file(remote['host'], remote['user'], output_uri, str(local_file)):
+        return None
+    
+    analysis = analyze_video(str(local_file), targets)
+    print(f"📈 分析: {analysis}")
     
-    return results
+    passed, issues = check_targets(analysis, targets)
+    return analysis, passed, issues
 
 
-def run_experiment(exp: Experiment, dry_run: bool = False):
+def run_experiment(exp: Experiment, dry_run: bool = False, use_cache: bool = True):
     """运行实验"""
     
     config = exp.config
     template = exp.template
     files = exp.files
     remote = config.get('remote', {})
-    uri_paths = config.get('uri_paths', {})
     targets = config.get('targets', {})
     metrics = config.get('metrics', [])
     
-    # 获取URI路径配置
-    input_uri_path = uri_paths.get('input', 'input.uri')
-    output_uri_path = uri_paths.get('output', 'output.uri')
-    
-    # 生成参数组合
+    # 生成参数组合 (惰性生成，不预先展开)
     param_defs = config.get('params', {})
-    combinations = generate_param_combinations(param_defs)
+    search = config.get('search') or {}
+    strategy = search.get('strategy', 'grid')
+    budget = search.get('budget')
+    combinations = generate_param_combinations(param_defs, strategy, budget)
+    combo_count = count_param_combinations(param_defs, strategy, budget)
     
     print(f"\n{'='*60}")
     print(f"📋 实验配置: {config.get('name', 'unnamed')}")
-    print(f"📊 参数组合: {len(combinations)} 种")
+    print(f"📊 参数组合: {combo_count} 种 ({strategy})")
     print(f"📁 文件数量: {len(files)}")
     print(f"🎯 目标: {targets}")
     print(f"{'='*60}\n")
@@ -383,102 +796,205 @@ def run_experiment(exp: Experiment, dry_run: bool = False):
     run_dir = exp.results_dir / timestamp
     run_dir.mkdir(parents=True, exist_ok=True)
     
-    all_results = []
+    if use_cache:
+        exp.load_cache()
+        if exp.analysis_cache:
+            print(f"♻️ 已缓存分析结果: {len(exp.analysis_cache)} 条")
+    
+    all_results = []  # 每个参数组合一项，文件结果先写 results.jsonl，最后再回填
     best_result = None
     best_score = float('inf')
     
-    total_tasks = len(combinations) * len(files)
-    task_idx = 0
+    total_tasks = combo_count * len(files)
     
-    # 遍历参数组合
-    for param_idx, params in enumerate(combinations, 1):
-        print(f"\n{'='*60}")
-        print(f"🔄 参数组合 [{param_idx}/{len(combinations)}]")
-        print(f"   {params}")
-        print(f"{'='*60}")
-        
-        param_results = {
-            'param_index': param_idx,
-            'params': params,
-            'files': []
-        }
-        
-        # 遍历文件
-        for file_idx, input_uri in enumerate(files, 1):
-            task_idx += 1
-            
-            # 生成输出URI
-            # 假设输入 file:///path/to/video.mp4 -> 输出 file:///path/to/video_out_paramX.mp4
-            input_basename = Path(input_uri.replace('file:', '')).stem
-            output_uri = f"file:/tmp/output/{input_basename}_p{param_idx}.mp4"
-            
-            print(f"\n[任务 {task_idx}/{total_tasks}] 处理: {input_uri}")
-            print(f"  输出: {output_uri}")
-            
-            # 构建请求payload
-            payload = inject_params(template, params)
-            set_nested_value(payload, input_uri_path, input_uri)
-            set_nested_value(payload, output_uri_path, output_uri)
+    # 提交-收割: 主线程连续提交转码，直到在途数达到 max_inflight；
+    # 每轮检查在途输出，就绪的交给线程池下载+分析，腾出的名额立即补交新任务
+    parallelism = config.get('parallelism', 8)
+    # max_concurrent_transcodes 是旧配置名，未设置 max_inflight 时沿用
+    max_inflight = config.get('max_inflight', config.get('max_concurrent_transcodes', 16))
+    pool = ThreadPoolExecutor(max_workers=parallelism)
+    # 大规模扫参时不逐任务写小文件，所有payload按任务顺序写入一个jsonl (第N行即任务N)
+    configs_file = None
+    if not config.get('save_per_task_config', True):
+        configs_file = open(run_dir / 'all_configs.jsonl', 'wb')
+    # 每个任务完成即追加一行，进程中途退出也不丢结果
+    results_path = run_dir / 'results.jsonl'
+    results_file = open(results_path, 'ab')
+    results_count = 0
+    unsaved_cache = 0
+    futures = {}  # future -> (param_results, task_idx, file_result, cache_key)
+    
+    def iter_tasks() -> Iterator[tuple]:
+        """按顺序生成任务: (param_results, task_idx, file_result, cache_key, payload)"""
+        task_idx = 0
+        # 遍历参数组合
+        for param_idx, params in enumerate(combinations, 1):
+            print(f"🔄 参数组合 [{param_idx}/{combo_count}] {params}")
             
-            # 保存配置
-            task_config_path = run_dir / f'task_{task_idx:04d}_config.json'
-            with open(task_config_path, 'w') as f:
-                json.dump(payload, f, indent=2, ensure_ascii=False)
+            param_results = {
+                'param_index': param_idx,
+                'params': params,
+                'files': []
+            }
+            all_results.append(param_results)
             
-            # 触发转码
-            success, task_id = trigger_transcode(config['api_url'], payload)
-            if not success:
-                continue
+            # 遍历文件
+            values = {split_path(path): value for path, value in params.items()}
             
-            # 等待完成
-            if not wait_for_output(remote['host'], remote['user'], output_uri):
-                print(f"[ERROR] 等待超时")
-                continue
+            for file_idx, input_uri in enumerate(files, 1):
+                task_idx += 1
+                
+                # 生成输出URI
+                # 假设输入 file:///path/to/video.mp4 -> 输出 file:/tmp/output/video_f<文件序号>_p<参数序号>.mp4
+                # 带上文件序号，不同目录下同名的输入不会写到同一个输出
+                input_basename = Path(input_uri.replace('file:', '')).stem
+                output_uri = f"file:/tmp/output/{input_basename}_f{file_idx}_p{param_idx}.mp4"
+                
+                # 构建请求payload: 模板不拷贝，只复制被修改路径上的字典
+                values[exp.input_uri_path] = input_uri
+                values[exp.output_uri_path] = output_uri
+                payload = exp.patcher(template, values)
+                
+                # 保存配置
+                if configs_file:
+                    configs_file.write(json_line(payload))
+                else:
+                    dump_json(run_dir / f'task_{task_idx:04d}_config.json', payload)
+                
+                file_result = {
+                    'file_index': file_idx,
+                    'input_uri': input_uri,
+                    'output_uri': output_uri,
+                }
+                yield param_results, task_idx, file_result, result_cache_key(input_uri, params), payload
+    
+    def handle(future: Future):
+        """汇总一个已完成的任务 (只在主线程调用，无需加锁)"""
+        nonlocal best_result, best_score, results_count, unsaved_cache
+        param_results, task_idx, file_result, cache_key = futures.pop(future)
+        outcome = future.result()
+        if outcome is None:
+            return
+        analysis, passed, issues = outcome
+        if use_cache and 'error' not in analysis and not file_result.get('cached'):
+            exp.analysis_cache[cache_key] = analysis
+            unsaved_cache += 1
+            if unsaved_cache >= CACHE_SAVE_EVERY:
+                exp.save_cache()
+                unsaved_cache = 0
+        file_result.update({
+            'analysis': analysis,
+            'passed': passed,
+            'issues': issues
+        })
+        input_uri = file_result['input_uri']
+        
+        if passed:
+            print(f"✅ 达标! [任务 {task_idx}]")
+            # 评分
+            score = abs(analysis.get('bitrate_avg', 0) - targets.get('bitrate_avg', 0))
+            if score < best_score:
+                best_score = score
+                best_result = {
+                    'task_index': task_idx,
+                    'param_index': param_results['param_index'],
+                    'params': param_results['params'],
+                    'file_result': file_result
+                }
+        else:
+            print(f"⚠️ 未达标 [任务 {task_idx}]: {issues}")
+        
+        # 通知
+        send_notification(
+            f"任务 {task_idx}/{total_tasks}",
+            f"{'✅' if passed else '⚠️'} {Path(input_uri).name}\n码率: {analysis.get('bitrate_avg', 'N/A')} kbps"
+        )
+        
+        results_file.write(json_line({
+            'param_index': param_results['param_index'],
+            'params': param_results['params'],
+            **file_result,
+        }))
+        results_file.flush()
+        results_count += 1
+        if results_count % RESULTS_FSYNC_EVERY == 0:
+            os.fsync(results_file.fileno())
+    
+    tasks = iter_tasks()
+    exhausted = False
+    poller = RemoteReadinessPoller(remote['host'], remote['user'])
+    interval = POLL_MIN
+    try:
+        while True:
+            # 提交: 补满在途名额
+            submitted = False
+            while not exhausted and len(poller) < max_inflight:
+                task = next(tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                param_results, task_idx, file_result, cache_key, payload = task
+                meta = (param_results, task_idx, file_result, cache_key)
+                
+                cached = exp.analysis_cache.get(cache_key) if use_cache else None
+                # 缓存里没有I帧统计而当前目标需要时，重新跑
+                if cached is not None and (not needs_packets(targets) or 'iframe_count' in cached):
+                    # 同一输入和参数之前已分析过，跳过转码/等待/下载
+                    future = Future()
+                    future.set_result((cached, *check_targets(cached, targets)))
+                    file_result['cached'] = True
+                    futures[future] = meta
+                    handle(future)
+                    continue
+                
+                print(f"[任务 {task_idx}/{total_tasks}] 输出: {file_result['output_uri']}")
+                success, task_id = trigger_transcode(config['api_url'], payload)
+                if success:
+                    poller.add(remote_path_of(file_result['output_uri']), meta)
+                    submitted = True
             
-            # 下载
-            local_file = run_dir / f'task_{task_idx:04d}_output.mp4'
-            if not download_file(remote['host'], remote['user'], output_uri, str(local_file)):
+            if not poller:
+                if exhausted:
+                    break
                 continue
             
-            # 分析
-            analysis = analyze_video(str(local_file))
-            print(f"📈 分析: {analysis}")
-            
-            # 检查达标
-            passed, issues = check_targets(analysis, targets)
+            # 收割: 就绪的输出交给线程池下载+分析
+            time.sleep(interval)
+            ready, _, changed = poller.poll()
+            for meta in ready:
+                local_file = run_dir / f'task_{meta[1]:04d}_output.mp4'
+                future = pool.submit(fetch_and_analyze, remote, meta[2]['output_uri'],
+                                     local_file, targets)
+                futures[future] = meta
             
-            file_result = {
-                'file_index': file_idx,
-                'input_uri': input_uri,
-                'output_uri': output_uri,
-                'analysis': analysis,
-                'passed': passed,
-                'issues': issues
-            }
-            
-            if passed:
-                print(f"✅ 达标!")
-                # 评分
-                score = abs(analysis.get('bitrate_avg', 0) - targets.get('bitrate_avg', 0))
-                if score < best_score:
-                    best_score = score
-                    best_result = {
-                        'param_index': param_idx,
-                        'params': params,
-                        'file_result': file_result
-                    }
-            else:
-                print(f"⚠️ 未达标: {issues}")
-            
-            # 通知
-            send_notification(
-                f"任务 {task_idx}/{total_tasks}",
-                f"{'✅' if passed else '⚠️'} {Path(input_uri).name}\n码率: {analysis.get('bitrate_avg', 'N/A')} kbps"
-            )
-            
-            param_results['files'].append(file_result)
+            for future in [f for f in futures if f.done()]:
+                handle(future)
+            # 有进展时保持高频检查，否则指数退避
+            interval = POLL_MIN if changed or submitted else min(interval * 2, POLL_MAX)
         
-        all_results.append(param_results)
+        for future in as_completed(list(futures)):
+            handle(future)
+    
+    finally:
+        # 中断时取消尚未开始的任务
+        pool.shutdown(cancel_futures=True)
+        if unsaved_cache:
+            exp.save_cache()
+        if configs_file:
+            configs_file.close()
+        os.fsync(results_file.fileno())
+        results_file.close()
+    
+    # 从 results.jsonl 流式回填各参数组合的文件结果
+    by_param = {r['param_index']: r for r in all_results}
+    passed_tasks = 0
+    for record in iter_jsonl(results_path):
+        param_results = by_param[record.pop('param_index')]
+        del record['params']
+        param_results['files'].append(record)
+        passed_tasks += bool(record.get('passed'))
+    for param_results in all_results:
+        param_results['files'].sort(key=lambda f: f['file_index'])
     
     # 最优结果评估
     if best_result and metrics:
@@ -486,10 +1002,13 @@ def run_experiment(exp: Experiment, dry_run: bool = False):
         print(f"🏆 最优结果 - 参数 #{best_result['param_index']}")
         print(f"{'='*60}")
         
-        best_file = run_dir / f"task_{best_result['param_index']:04d}_output.mp4"
+        # 命中缓存的任务没有下载输出文件，无法评估
+        best_file = run_dir / f"task_{best_result['task_index']:04d}_output.mp4"
         # TODO: 参考视频路径需要配置
         ref_video = config.get('reference_video')
-        if ref_video and Path(ref_video).exists():
+        if best_result['file_result'].get('cached'):
+            print("⚠️ 最优结果来自分析缓存，没有本地输出文件，跳过质量评估")
+        elif ref_video and Path(ref_video).exists() and best_file.exists():
             metric_results = run_metrics(str(best_file), ref_video, metrics)
             best_result['metrics'] = metric_results
             print(f"📊 质量评估:")
@@ -505,13 +1024,12 @@ def run_experiment(exp: Experiment, dry_run: bool = False):
         'experiment': config.get('name'),
         'timestamp': timestamp,
         'total_tasks': total_tasks,
-        'passed_tasks': sum(1 for r in all_results for f in r['files'] if f['passed']),
+        'passed_tasks': passed_tasks,
         'best': best_result,
         'all_results': all_results
     }
     
-    with open(run_dir / 'summary.json', 'w', encoding='utf-8') as f:
-        json.dump(summary, f, indent=2, ensure_ascii=False)
+    dump_json(run_dir / 'summary.json', summary)
     
     print(f"\n📁 结果已保存: {run_dir}")
     print(f"🎉 实验完成!")
@@ -524,6 +1042,7 @@ def main():
     parser.add_argument('experiment', nargs='?', help='实验目录路径')
     parser.add_argument('--new', '-n', metavar='NAME', help='创建新实验')
     parser.add_argument('--dry-run', action='store_true', help='预览不执行')
+    parser.add_argument('--no-cache', action='store_true', help='忽略历史分析结果，全部重新转码')
     args = parser.parse_args()
     
     exp = Experiment(args.experiment or '.')
@@ -546,7 +1065,7 @@ def main():
     if not exp.load():
         return
     
-    run_experiment(exp, args.dry_run)
+    run_experiment(exp, args.dry_run, use_cache=not args.no_cache)
 
 
 if __name__ == '__main__':